@@ -18,49 +18,100 @@ Modified by: David Widmann 2021
 """
 import json
 import argparse
+import os
 import nbformat
 
-import copy
-import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from traitlets.config import Config
-from nbconvert import HTMLExporter, PDFExporter, LatexExporter
-from nbconvert.writers import FilesWriter
-from bs4 import BeautifulSoup
+from jinja2 import DictLoader
+from nbconvert import HTMLExporter
+from nbformat import NotebookNode
 from pathlib import Path
 
+try:
+    import re2 as re
+except ImportError:
+    import re
 
-def export_html(notebook, path):
-    """Export `notebook` as HTML file to `path`."""
-    c = Config()
-    c.FilesWriter.build_directory = path.parent.as_posix()
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    _json_loads = json.loads
 
-    # remove '#<keep>' and '#</keep>'
-    notebook = copy.deepcopy(notebook)
-    for cell in notebook.cells:
-        if cell.get('cell_type') == 'code':
-            cell.source = re.sub('#<\/?keep>(?:\n|$)', '', cell.source)
+# '#<keep>' and '#</keep>' markers (including a trailing newline, if present)
+_KEEP_STRIP_RE = re.compile(r'#</?keep>(?:\n|$)')
+# delimiters of blocks in code cells whose content is kept
+_KEEP_OPEN = '#<keep>\n'
+_KEEP_CLOSE = '#</keep>'
 
-    # export notebook as HTML
-    html_exporter = HTMLExporter(config=c)
-    html = html_exporter.from_notebook_node(notebook)
-
-    # add CSS that makes it more difficult to copy solutions
-    soup = BeautifulSoup(html[0], 'html5lib')    
-    style = soup.new_tag('style')
-    style.attrs['type'] = 'text/css'
-    style.string = """.input .inner_cell .input_area pre {
+# HTML template that adds CSS that makes it more difficult to copy solutions
+_HTML_TEMPLATE = """{%- extends 'lab/index.html.j2' -%}
+{%- block html_head -%}
+{{ super() }}
+<style type="text/css">
+    .input .inner_cell .input_area pre {
         -webkit-touch-callout: none;
         -webkit-user-select: none;
         -khtml-user-select: none;
         -moz-user-select: none;
         -ms-user-select: none;
         user-select: none;
-    }"""
-    soup.head.append(style)
+    }
+</style>
+{%- endblock html_head -%}
+"""
+
+# HTML exporter (shared by all notebooks, to load templates only once)
+_HTML_EXPORTER = HTMLExporter(
+    extra_loaders=[DictLoader({'public.html.j2': _HTML_TEMPLATE})],
+    template_file='public.html.j2')
+
+
+def extract_keep(source):
+    """Concatenate all blocks of `source` enclosed by '#<keep>\n' and
+    '#</keep>\n' or '#</keep>$' (end of string)."""
+    blocks = []
+    start = source.find(_KEEP_OPEN)
+    while start >= 0:
+        start += len(_KEEP_OPEN)
+
+        # find closing delimiter followed by a newline or the end of the string
+        end = source.find(_KEEP_CLOSE, start)
+        while end >= 0:
+            stop = end + len(_KEEP_CLOSE)
+            if stop == len(source) or source[stop] == '\n':
+                break
+            end = source.find(_KEEP_CLOSE, end + 1)
+        if end < 0:
+            break
+
+        blocks.append(source[start:end])
+        start = source.find(_KEEP_OPEN, stop)
+    return "".join(blocks)
 
-    writer = FilesWriter(config=c)
-    writer.write(str(soup), *html[1:], path.stem)
+
+def export_html(notebook, path):
+    """Export `notebook` as HTML file to `path`."""
+    # remove '#<keep>' and '#</keep>'
+    # (only the source of code cells changes, so shallow copies are sufficient)
+    cells = [NotebookNode(cell, source=_KEEP_STRIP_RE.sub('', cell.source))
+             if cell.get('cell_type') == 'code' else cell
+             for cell in notebook.cells]
+    notebook = NotebookNode(notebook, cells=cells)
+
+    # export notebook as HTML
+    html, resources = _HTML_EXPORTER.from_notebook_node(notebook)
+
+    # write resources (if any) and HTML file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for filename, data in resources.get('outputs', {}).items():
+        resource_path = path.parent / filename
+        resource_path.parent.mkdir(parents=True, exist_ok=True)
+        resource_path.write_bytes(data)
+    path.write_bytes(html.encode('utf-8'))
     print(f"Writing file { path }")
 
 
@@ -68,50 +119,49 @@ def export_clean(notebook, path):
     """Clean `notebook` and save it as `path`."""
     new_cells = []
     last_was_empty_code_cell = False
-    keep_regex = r'#<keep>\n(.*?)#</keep>(?:\n|$)'
-    notebook = copy.deepcopy(notebook)
     for cell in notebook.cells:
-        # obtain and remove tags
-        tags = cell.get('metadata', {}).get('tags', [])
-        cell['metadata']['tags'] = []
-
-        # remove cells tagged with 'remove'
+        # obtain tags and remove cells tagged with 'remove'
+        tags = cell.get('metadata', {}).get('tags', ())
         if 'remove' in tags:
             continue
 
+        # remove tags (on a shallow copy, to leave `notebook` untouched)
+        metadata = NotebookNode(cell.metadata, tags=[])
+
         # copy other non-code cells
         if cell.cell_type != 'code':
-            new_cells.append(cell)
+            new_cells.append(NotebookNode(cell, metadata=metadata))
             last_was_empty_code_cell = False
             continue
 
         # handle remaining code cells
-        # remove execution count (the number on the left side) and output
-        if cell.execution_count:
-            cell.execution_count = None
-        if cell.outputs:
-            cell.outputs = []
-
         if 'keep' in tags:
             # copy code cell if it is tagged with 'keep'
-            new_cells.append(cell)
-            last_was_empty_code_cell = not cell.source
+            source = cell.source
         else:
             # otherwise only keep content between '#<keep>\n' and '#</keep>\n'
             # or '#</keep>$' (end of string)
-            cell.source = "".join(re.findall(keep_regex, cell.source, re.DOTALL))
+            source = extract_keep(cell.source)
 
             # remove code cell completely if it is empty and the last cell was
             # also an empty code cell
-            cell_is_empty = not cell.source
-            if not (cell_is_empty and last_was_empty_code_cell):
-                new_cells.append(cell)
-                last_was_empty_code_cell = cell_is_empty
+            if not source and last_was_empty_code_cell:
+                continue
+
+        # remove execution count (the number on the left side) and output
+        new_cells.append(NotebookNode(cell, metadata=metadata, source=source,
+                                      execution_count=None, outputs=[]))
+        last_was_empty_code_cell = not source
 
-    notebook.cells = new_cells        
-    with path.open('w') as file:
-        json.dump(notebook, file)
-        print(f"Writing file {path}")
+    # only save the fields of the notebook format
+    clean_notebook = {
+        'cells': new_cells,
+        'metadata': notebook.metadata,
+        'nbformat': notebook.nbformat,
+        'nbformat_minor': notebook.nbformat_minor,
+    }
+    path.write_bytes(_json_dumps(clean_notebook))
+    print(f"Writing file {path}")
 
 
 def get_parser():
@@ -127,40 +177,83 @@ def get_parser():
     parser.add_argument("-o", "--outdir",
                         default=".",
                         help="Output directory (files are exported to subdirectory 'build').")
+    parser.add_argument("-f", "--force",
+                        action='store_true',
+                        help="Export notebooks even if the exported files are up to date.")
     return parser
 
 
+def is_up_to_date(path, source):
+    """Check if `path` exists and is newer than `source`."""
+    try:
+        return path.stat().st_mtime > source.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def process_notebook(file, outdir, extension, force=False):
+    """Export notebook `file` as HTML file and cleaned notebook to `outdir`.
+
+    Exported files that are newer than `file` are skipped unless `force` is set.
+    """
+    print(f"Processing {file.name}")
+
+    # check which exported files have to be updated
+    html_file = outdir / "solutions" / f"{file.stem}.html"
+    clean_file = outdir / f"{file.stem}.{extension}"
+    update_html = force or not is_up_to_date(html_file, file)
+    update_clean = force or not is_up_to_date(clean_file, file)
+    if not (update_html or update_clean):
+        print(f"Skipping {file.name} (exported files are up to date)")
+        return
+
+    # read notebook
+    # (version 4 notebooks are not validated, older versions are converted)
+    data = file.read_bytes()
+    notebook = _json_loads(data)
+    if notebook.get('nbformat') == 4:
+        notebook = nbformat.v4.to_notebook(notebook)
+    else:
+        notebook = nbformat.reads(data.decode('utf-8'), as_version=4)
+
+    # export as HTML
+    if update_html:
+        export_html(notebook, html_file)
+
+    # export clean notebook
+    if update_clean:
+        export_clean(notebook, clean_file)
+
+
 def main():
     # parse arguments
     args = get_parser().parse_args()
 
     # find notebooks
     paths = [Path(path) for path in args.path]
+    suffix = f".{args.extension}"
     files = set()
     for path in paths:
         if path.is_file():
-            if path.suffix == f".{args.extension}":
+            if path.suffix == suffix:
                 files.add(path)
-        else:
-            files |= set(path.glob(f"./*.{args.extension}"))
+        elif path.is_dir():
+            with os.scandir(path) as entries:
+                files.update(Path(entry.path) for entry in entries
+                             if entry.name.endswith(suffix) and entry.is_file())
 
     # define directory for exported files
     outdir = Path(args.outdir).resolve() / "build"
 
-    for file in files:
-        print(f"Processing {file.name}")
-
-        # read notebook
-        with file.open() as f:
-            notebook = nbformat.read(f, as_version=4)
-
-        # export as HTML
-        html_file = outdir / "solutions" / f"{file.stem}.html"
-        export_html(notebook, html_file)
-
-        # export clean notebook
-        clean_file = outdir / f"{file.stem}.{args.extension}"
-        export_clean(notebook, clean_file)
+    # process notebooks in parallel if there is more than one
+    process = partial(process_notebook, outdir=outdir, extension=args.extension,
+                      force=args.force)
+    if len(files) > 1:
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(process, files))
+    else:
+        for file in files:
+            process(file)
 
 
 if __name__ == "__main__":